@@ -2,20 +2,46 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import gzip
+import bisect
+import heapq
+import io
 import json
 import logging
+import mmap
+import multiprocessing
 import os
+import queue
 import re
-import statistics
 import sys
-from collections import defaultdict, namedtuple
+from array import array
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
 from datetime import datetime
-from string import Template
-from typing import Dict, Iterator, List, Optional, Protocol, TextIO, cast
+from functools import lru_cache
+from math import floor, log
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
 import structlog
 
+# ISA-L inflate is a drop-in, several times faster replacement for zlib
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip  # type: ignore[no-redef, unused-ignore]
+
+# orjson serializes the report table several times faster than json
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment, unused-ignore]
+
+# rapidgzip decompresses a single gzip stream on several cores at once
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
 # Setting up the default config
 default_config = {
     "REPORT_SIZE": 1000,
@@ -25,24 +51,57 @@ default_config = {
 }
 default_config_path = "config.json"
 
-# Structure for log file information
-LogFileInfo = namedtuple("LogFileInfo", ["path", "date", "extension"])
-
-# Pattern for parsing logs ui_short
-LOG_PATTERN = re.compile(
-    r"(?P<remote_addr>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}) "
-    r"(?P<remote_user>\S+) +(?P<http_x_real_ip>\S+) +\[(?P<time_local>[^\]]+)\] "
-    r'"(?P<request>[^"]*)" '
-    r"(?P<status>\d{3}) "
-    r"(?P<body_bytes_sent>\d+) "
-    r'"(?P<http_referer>[^"]*)" '
-    r'"(?P<http_user_agent>[^"]*)" '
-    r'"(?P<http_x_forwarded_for>[^"]*)" '
-    r'"(?P<http_X_REQUEST_ID>[^"]*)" '
-    r'"(?P<http_X_RB_USER>[^"]*)" '
-    r"(?P<request_time>\d+\.\d+)"
+# Module logger, bound once instead of looked up on every call
+logger = structlog.get_logger(__name__)
+
+
+class LogFileInfo(NamedTuple):
+    """Structure for log file information"""
+
+    path: str
+    date: datetime
+    extension: str
+
+
+# Per-URL aggregates: URL -> url_id mapping and parallel arrays by url_id
+UrlAggregates = namedtuple(
+    "UrlAggregates", ["url_ids", "counts", "time_sums", "time_maxes", "medians"]
 )
 
+# Buffer size for reading decompressed logs
+READ_BUFFER_SIZE = 128 * 1024
+
+# Buffer size for reading the compressed data of gzipped logs
+COMPRESSED_BUFFER_SIZE = 1024 * 1024
+
+# Logs at least this large on disk are parsed by several processes
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+
+# Size of the decompressed batches a gzipped log is parsed in by workers
+BATCH_SIZE = 8 * 1024 * 1024
+
+# Queue of gzipped log batches, set in the worker processes that take them
+_batch_queue: Optional["multiprocessing.Queue[Optional[bytes]]"] = None
+
+# Observations kept per URL before time_med switches to a histogram
+MEDIAN_EXACT_SAMPLES = 64
+
+# Largest relative error of time_med from a histogram
+MEDIAN_RELATIVE_ACCURACY = 0.01
+
+# Histogram bucket k holds timings in [GROWTH**k, GROWTH**(k + 1)), and its
+# value, 2 * GROWTH**(k + 1) / (GROWTH + 1), is within the accuracy of both
+_BUCKET_GROWTH = (1 + MEDIAN_RELATIVE_ACCURACY) / (1 - MEDIAN_RELATIVE_ACCURACY)
+_BUCKET_SCALE = 1 / log(_BUCKET_GROWTH)
+_BUCKET_VALUE = 2 * _BUCKET_GROWTH / (_BUCKET_GROWTH + 1)
+
+# Number of parsed lines between progress messages
+PROGRESS_INTERVAL = 100000
+
+# Quoted fields of a log line: request, referer, user agent, forwarded for,
+# request id and user
+LOG_QUOTED_FIELDS = 6
+
 # Pattern for searching log files
 LOG_FILE_PATTERN = re.compile(r"nginx-access-ui\.log-(\d{8})(\.gz)?$")
 
@@ -77,22 +136,32 @@ def setup_logging(log_file: Optional[str] = None) -> None:
         logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
 
 
+@lru_cache(maxsize=32)
+def _read_config_file(config_path: str, mtime_ns: int) -> Dict:
+    """Parsing a config file, cached until the file changes"""
+    # mtime_ns is only part of the cache key: a changed file is a cache miss
+    with open(config_path, "rb") as f:
+        data = f.read()
+    try:
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+    except json.JSONDecodeError as e:
+        # orjson.JSONDecodeError is a subclass of json.JSONDecodeError
+        raise ValueError(f"Invalid JSON in config file: {e}")
+
+
 def load_config(config_path: str, default: Dict) -> Dict:
     """Loading and merging configuration"""
     config = default.copy()
 
-    logger = structlog.get_logger()
-
-    if not os.path.exists(config_path):
+    try:
+        mtime = os.stat(config_path).st_mtime_ns
+    except OSError:
         logger.info(f"Config file not found: {config_path}, using default config")
         return config
 
-    try:
-        with open(config_path, "r", encoding="utf-8") as f:
-            file_config = json.load(f)
-            config.update(file_config)
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Invalid JSON in config file: {e}")
+    config.update(_read_config_file(config_path, mtime))
 
     logger.info("config_loaded", config_path=config_path)
     return config
@@ -103,106 +172,247 @@ def find_latest_log(log_dir: str) -> Optional[LogFileInfo]:
     if not os.path.exists(log_dir):
         return None
 
-    latest_log = None
-    latest_date = None
+    # YYYYMMDD compares as an integer in date order
+    with os.scandir(log_dir) as entries:
+        candidates = [
+            (int(match.group(1)), entry.path, match.group(2) or "")
+            for entry in entries
+            if (match := LOG_FILE_PATTERN.match(entry.name))
+        ]
+
+    # Only the newest name is turned into a datetime; invalid dates are skipped
+    while candidates:
+        latest = max(candidates)
+        date_key, path, extension = latest
+        try:
+            log_date = datetime(
+                date_key // 10000, date_key // 100 % 100, date_key % 100
+            )
+        except ValueError:
+            candidates.remove(latest)
+            continue
+        return LogFileInfo(path=path, date=log_date, extension=extension)
 
-    for filename in os.listdir(log_dir):
-        match = LOG_FILE_PATTERN.match(filename)
-        if match:
-            date_str = match.group(1)
-            try:
-                log_date = datetime.strptime(date_str, "%Y%m%d")
-                if latest_date is None or log_date > latest_date:
-                    latest_date = log_date
-                    extension = match.group(2) or ""
-                    latest_log = LogFileInfo(
-                        path=os.path.join(log_dir, filename),
-                        date=log_date,
-                        extension=extension,
-                    )
-            except ValueError:
-                continue
-
-    return latest_log
-
-
-def parse_log_line(line: str) -> Optional[Dict]:
-    """Parsing one line of log"""
-    match = LOG_PATTERN.match(line.strip())
-    if not match:
+    return None
+
+
+def _decode_url(url: bytes, url_pool: Dict[bytes, str]) -> str:
+    """Decoding a URL, sharing one str object per distinct URL in the pool"""
+    decoded = url_pool.get(url)
+    if decoded is None:
+        decoded = url_pool[url] = url.decode("utf-8", "replace")
+    return decoded
+
+
+def parse_log_line(
+    line: bytes, url_pool: Optional[Dict[bytes, str]] = None
+) -> Optional[Tuple[str, float]]:
+    """Parsing one line of log
+
+    Repeated URLs decoded through the same url_pool share one str object.
+    """
+    # nginx escapes quotes inside fields, so a line in the log format has
+    # exactly the quotes of its quoted fields
+    if line.count(b'"') != 2 * LOG_QUOTED_FIELDS:
         return None
 
-    data = match.groupdict()
+    # Only the quoted request and the trailing request_time are needed.
+    # The fields before the request never contain quotes, so splitting on
+    # the first two quotes isolates the request.
+    parts = line.split(b'"', 2)
+
+    # request_time is the field right after the last quoted one, plain
+    # digits with a decimal point; anything after it is ignored, as the
+    # line is not matched to its end. float() alone would also take nan,
+    # inf, -1.5, 1e3 or 1_0.
+    tokens = line[line.rfind(b'"') + 1 :].split(None, 1)
+    if not tokens:
+        return None
+    field = tokens[0]
+    head, dot, tail = field.partition(b".")
+    if not (dot and head.isdigit() and tail.isdigit()):
+        return None
+    request_time = float(field)
 
     # Extract URL from request
-    request_parts = data["request"].split()
-    if len(request_parts) >= 2:
-        url = request_parts[1]
-    else:
-        url = data["request"]
+    request = parts[1]
+    request_parts = request.split(b" ", 2)
+    url = request_parts[1] if len(request_parts) >= 2 else request
+
+    if url_pool is None:
+        return url.decode("utf-8", "replace"), request_time
+    return _decode_url(url, url_pool), request_time
+
+
+@contextmanager
+def open_gzip_log(file_path: str) -> Iterator[io.BufferedReader]:
+    """Opening a gzipped log file for buffered binary reading"""
+    with ExitStack() as stack:
+        cpu_count = os.cpu_count() or 1
+        if rapidgzip is not None and cpu_count > 1:
+            gz = stack.enter_context(
+                rapidgzip.open(file_path, parallelization=cpu_count)
+            )
+        else:
+            # Before Python 3.12 GzipFile reads the compressed file in 8KB
+            # pieces; a large buffer underneath turns them into few syscalls
+            raw = stack.enter_context(
+                open(file_path, "rb", buffering=COMPRESSED_BUFFER_SIZE)
+            )
+            gz = stack.enter_context(gzip.GzipFile(fileobj=raw))
+
+        # GzipFile buffers its output in 8KB blocks; a larger buffer on top
+        # of it makes far fewer decompression calls per line
+        yield stack.enter_context(io.BufferedReader(gz, buffer_size=READ_BUFFER_SIZE))
+
+
+def read_log_batches(file_path: str, batch_size: int) -> Iterator[bytes]:
+    """Reading a gzipped log file in batches of whole lines"""
+    with open_gzip_log(file_path) as f:
+        while True:
+            batch = f.read(batch_size)
+            if not batch:
+                return
+            # Complete the last line of the batch
+            if not batch.endswith(b"\n"):
+                batch += f.readline()
+            yield batch
+
+
+def read_log_lines(
+    file_path: str, start: int = 0, end: Optional[int] = None
+) -> Iterator[bytes]:
+    """Reading raw lines of a plain or gzipped log file
+
+    A plain file can be limited to the lines starting in [start, end),
+    where start is expected to be the beginning of a line.
+    """
+    if file_path.endswith(".gz"):
+        with open_gzip_log(file_path) as f:
+            yield from f
+        return
+
+    with open(file_path, "rb") as f:
+        # An empty file cannot be memory-mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+
+        # Plain logs are mapped into memory and split into lines by
+        # mmap.readline, which scans the page cache directly
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            mm.seek(start)
+            if end is None:
+                yield from iter(mm.readline, b"")
+                return
+
+            readline = mm.readline
+            tell = mm.tell
+            while tell() < end:
+                yield readline()
+
+
+def find_chunk_offsets(file_path: str, chunks: int) -> List[Tuple[int, int]]:
+    """Splitting a plain log file into byte ranges aligned to line starts"""
+    size = os.path.getsize(file_path)
+    offsets = [0]
+
+    with open(file_path, "rb") as f:
+        for i in range(1, chunks):
+            f.seek(max(size * i // chunks, offsets[-1]))
+            f.readline()
+            offset = f.tell()
+            if offset < size and offset > offsets[-1]:
+                offsets.append(offset)
+
+    offsets.append(size)
+    return list(zip(offsets, offsets[1:]))
+
+
+def check_error_rate(
+    total_lines: int, error_lines: int, error_threshold: float
+) -> None:
+    """Error threshold check"""
+    if total_lines == 0:
+        return
+
+    error_rate = error_lines / total_lines
+    if error_rate > error_threshold:
+        logger.error(
+            "error_threshold_exceeded",
+            error_rate=error_rate,
+            threshold=error_threshold,
+            total_lines=total_lines,
+            error_lines=error_lines,
+        )
+        raise ValueError(
+            f"Error rate {error_rate:.2%} exceeds threshold {error_threshold:.2%}"
+        )
 
-    return {"url": url, "request_time": float(data["request_time"])}
 
+class LineCounts:
+    """Total and error line counts of a parsing run"""
 
-# Define a Protocol for file openers to handle both open and gzip.open
-class FileOpener(Protocol):
-    def __call__(self, file: str, mode: str, encoding: Optional[str] = None) -> TextIO:
-        pass
+    __slots__ = ("total_lines", "error_lines")
 
+    def __init__(self) -> None:
+        self.total_lines = 0
+        self.error_lines = 0
 
-def parse_log_file(file_path: str, error_threshold: float) -> Iterator[Dict]:
-    """Log file parsing generator"""
-    logger = structlog.get_logger()
 
-    # Select the method for opening the file
-    file_opener: FileOpener
-    if file_path.endswith(".gz"):
-        file_opener = cast(FileOpener, gzip.open)
-        mode = "rt"
-    else:
-        file_opener = cast(FileOpener, open)
-        mode = "r"
+def parse_log_lines(
+    lines: Iterable[bytes], counts: LineCounts
+) -> Iterator[Tuple[str, float]]:
+    """Parsing raw log lines, adding up total and error lines in counts
 
-    total_lines = 0
-    error_lines = 0
+    Progress is logged by the process that parses the lines.
+    """
+    total_lines = counts.total_lines
+    error_lines = counts.error_lines
+    next_progress = total_lines + PROGRESS_INTERVAL
+    parse = parse_log_line
+    # Decoded URLs of these lines only, freed with the generator
+    url_pool: Dict[bytes, str] = {}
 
     try:
-        with file_opener(file_path, mode, encoding="utf-8") as f:
-            for line in f:
-                total_lines += 1
-                parsed = parse_log_line(line)
-
-                if parsed:
-                    yield parsed
-                else:
-                    error_lines += 1
-
-                # Periodic logging of progress
-                if total_lines % 100000 == 0:
-                    logger.info(
-                        "parse_progress",
-                        total_lines=total_lines,
-                        error_lines=error_lines,
-                    )
-
+        for line in lines:
+            total_lines += 1
+            parsed = parse(line, url_pool)
+
+            if parsed:
+                yield parsed
+            else:
+                error_lines += 1
+
+            # Periodic logging of progress
+            if total_lines == next_progress:
+                next_progress += PROGRESS_INTERVAL
+                logger.info(
+                    "parse_progress",
+                    total_lines=total_lines,
+                    error_lines=error_lines,
+                    pid=os.getpid(),
+                )
+    finally:
+        # Kept in locals while parsing, stored once the lines end
+        counts.total_lines = total_lines
+        counts.error_lines = error_lines
+
+
+@contextmanager
+def log_parse_errors(file_path: str) -> Iterator[None]:
+    """Logging an error raised while parsing a log before passing it on"""
+    try:
+        yield
     except Exception as e:
         logger.error("parse_error", error=str(e), file=file_path)
         raise
 
-    # Error threshold check
-    if total_lines > 0:
-        error_rate = error_lines / total_lines
-        if error_rate > error_threshold:
-            logger.error(
-                "error_threshold_exceeded",
-                error_rate=error_rate,
-                threshold=error_threshold,
-                total_lines=total_lines,
-                error_lines=error_lines,
-            )
-            raise ValueError(
-                f"Error rate {error_rate:.2%} exceeds threshold {error_threshold:.2%}"
-            )
+
+def finish_parse(counts: LineCounts, error_threshold: float) -> None:
+    """Checking the error rate of a parsed log and logging its totals"""
+    total_lines = counts.total_lines
+    error_lines = counts.error_lines
+    check_error_rate(total_lines, error_lines, error_threshold)
 
     logger.info(
         "parse_complete",
@@ -212,88 +422,413 @@ def parse_log_file(file_path: str, error_threshold: float) -> Iterator[Dict]:
     )
 
 
-def calculate_statistics(log_entries: List[Dict]) -> Dict[str, Dict]:
+def parse_log_file(
+    file_path: str, error_threshold: float
+) -> Iterator[Tuple[str, float]]:
+    """Log file parsing generator"""
+    counts = LineCounts()
+    with log_parse_errors(file_path):
+        yield from parse_log_lines(read_log_lines(file_path), counts)
+    finish_parse(counts, error_threshold)
+
+
+class MedianHistogram:
+    """Streaming median estimate from a histogram with log-spaced buckets
+
+    Bucket bounds grow by a fixed factor, so every bucket value is within
+    MEDIAN_RELATIVE_ACCURACY of the observations in it, and so is the
+    median. Unlike order-sensitive estimators (e.g. P-square), the result
+    does not depend on the order of the observations, and merging two
+    histograms gives the same buckets as adding all observations to one.
+    """
+
+    __slots__ = ("count", "samples", "zeros", "buckets")
+
+    def __init__(self) -> None:
+        self.count = 0
+        # Observations kept sorted while there are few of them
+        self.samples: List[float] = []
+        # Number of zero timings, which have no logarithm
+        self.zeros = 0
+        # Bucket index -> number of observations in it
+        self.buckets: Dict[int, int] = {}
+
+    def add(self, x: float) -> None:
+        """Adding one observation"""
+        count = self.count = self.count + 1
+
+        # The first observations are kept as is, so the median is exact
+        if count <= MEDIAN_EXACT_SAMPLES:
+            bisect.insort(self.samples, x)
+            return
+        if count == MEDIAN_EXACT_SAMPLES + 1:
+            self._add_to_buckets(self.samples)
+            self.samples = []
+
+        if x > 0:
+            key = floor(log(x) * _BUCKET_SCALE)
+            buckets = self.buckets
+            buckets[key] = buckets.get(key, 0) + 1
+        else:
+            self.zeros += 1
+
+    def _add_to_buckets(self, values: Iterable[float]) -> None:
+        """Counting observations into the buckets"""
+        buckets = self.buckets
+        for x in values:
+            if x > 0:
+                key = floor(log(x) * _BUCKET_SCALE)
+                buckets[key] = buckets.get(key, 0) + 1
+            else:
+                self.zeros += 1
+
+    def merge(self, other: "MedianHistogram") -> None:
+        """Merging in another histogram
+
+        Exact while both sides together hold at most MEDIAN_EXACT_SAMPLES
+        observations. Otherwise the buckets are summed, which gives the same
+        median as adding every observation to a single histogram.
+        """
+        count = self.count + other.count
+        if count <= MEDIAN_EXACT_SAMPLES:
+            self.samples = sorted(self.samples + other.samples)
+            self.count = count
+            return
+
+        if self.count <= MEDIAN_EXACT_SAMPLES:
+            self._add_to_buckets(self.samples)
+            self.samples = []
+
+        if other.count <= MEDIAN_EXACT_SAMPLES:
+            self._add_to_buckets(other.samples)
+        else:
+            buckets = self.buckets
+            for key, bucket_count in other.buckets.items():
+                buckets[key] = buckets.get(key, 0) + bucket_count
+            self.zeros += other.zeros
+
+        self.count = count
+
+    def median(self) -> float:
+        """Current median (exact while observations are kept)"""
+        count = self.count
+        if count == 0:
+            return 0.0
+        if count <= MEDIAN_EXACT_SAMPLES:
+            # The observations are kept sorted, so no selection is needed
+            q = self.samples
+            k = count // 2
+            return q[k] if count & 1 else (q[k - 1] + q[k]) / 2
+
+        # The median is the mean of the observations at these two ranks,
+        # which are the same one for an odd count
+        low_rank = (count - 1) // 2
+        high_rank = count // 2
+        low = high = 0.0
+        seen = self.zeros
+        if seen > high_rank:
+            return 0.0
+        buckets = self.buckets
+        for key in sorted(buckets):
+            seen += buckets[key]
+            if seen > low_rank:
+                # Middle of the bucket in relative terms
+                value = _BUCKET_VALUE * _BUCKET_GROWTH**key
+                if low_rank >= seen - buckets[key]:
+                    low = value
+                if seen > high_rank:
+                    high = value
+                    break
+        return (low + high) / 2
+
+
+def aggregate_log_entries(log_entries: Iterable[Tuple[str, float]]) -> UrlAggregates:
+    """Aggregating (url, request_time) log entries by URL"""
+    aggregates = UrlAggregates({}, array("Q"), array("d"), array("d"), [])
+    url_ids, counts, time_sums, time_maxes, medians = aggregates
+    # Bound method kept in a local for the per-line lookup
+    get_url_id = url_ids.get
+
+    for url, request_time in log_entries:
+        url_id = get_url_id(url)
+        if url_id is None:
+            # The first request of a URL initializes its slot
+            url_ids[url] = len(counts)
+            counts.append(1)
+            time_sums.append(request_time)
+            time_maxes.append(request_time)
+            median = MedianHistogram()
+            median.add(request_time)
+            medians.append(median)
+            continue
+
+        counts[url_id] += 1
+        time_sums[url_id] += request_time
+        if request_time > time_maxes[url_id]:
+            time_maxes[url_id] = request_time
+        medians[url_id].add(request_time)
+
+    return aggregates
+
+
+def merge_aggregates(target: UrlAggregates, other: UrlAggregates) -> None:
+    """Merging per-URL aggregates of another part of the log into target"""
+    url_ids, counts, time_sums, time_maxes, medians = target
+
+    for url, count, time_sum, time_max, median in zip(*other):
+        url_id = url_ids.get(url)
+        if url_id is None:
+            url_ids[url] = len(counts)
+            counts.append(count)
+            time_sums.append(time_sum)
+            time_maxes.append(time_max)
+            medians.append(median)
+            continue
+
+        counts[url_id] += count
+        time_sums[url_id] += time_sum
+        if time_max > time_maxes[url_id]:
+            time_maxes[url_id] = time_max
+        medians[url_id].merge(median)
+
+
+def summarize_aggregates(
+    aggregates: UrlAggregates, limit: Optional[int] = None
+) -> Dict[str, Dict]:
+    """Calculating final per-URL metrics, for the top limit URLs by time_sum"""
+    url_ids, counts, time_sums, time_maxes, medians = aggregates
+    total_count = sum(counts)
+    total_time = sum(time_sums)
+
+    # url_ids preserves insertion order, so it lines up with the arrays
+    urls = list(url_ids)
+    selected: Iterable[int] = range(len(urls))
+    if limit is not None:
+        # Metrics are only built for URLs that can make it into the report
+        selected = heapq.nlargest(limit, selected, key=time_sums.__getitem__)
+
+    result = {}
+    for url_id in selected:
+        count = counts[url_id]
+        time_sum = time_sums[url_id]
+        result[urls[url_id]] = {
+            "count": count,
+            "count_perc": (
+                round(count / total_count * 100, 2) if total_count > 0 else 0
+            ),
+            "time_sum": round(time_sum, 3),
+            "time_perc": round(time_sum / total_time * 100, 2) if total_time > 0 else 0,
+            "time_avg": round(time_sum / count, 3),
+            "time_max": round(time_maxes[url_id], 3),
+            "time_med": round(medians[url_id].median(), 3),
+        }
+
+    return result
+
+
+def calculate_statistics(
+    log_entries: Iterable[Tuple[str, float]], limit: Optional[int] = None
+) -> Dict[str, Dict]:
     """Calculating statistics by URL"""
+    return summarize_aggregates(aggregate_log_entries(log_entries), limit)
 
-    def create_stats_dict() -> dict:
-        return {"count": 0, "time_sum": 0.0, "time_list": []}
 
-    url_stats: dict = defaultdict(create_stats_dict)
+def aggregate_log_lines(lines: Iterable[bytes]) -> Tuple[UrlAggregates, int, int]:
+    """Parsing and aggregating raw log lines, counting total and error lines"""
+    counts = LineCounts()
+    aggregates = aggregate_log_entries(parse_log_lines(lines, counts))
+    return aggregates, counts.total_lines, counts.error_lines
 
-    total_count = 0
-    total_time = 0.0
 
-    for entry in log_entries:
-        url = entry["url"]
-        request_time = entry["request_time"]
+def aggregate_log_chunk(
+    file_path: str, start: int, end: int
+) -> Tuple[UrlAggregates, int, int]:
+    """Parsing and aggregating one byte range of a plain log file"""
+    return aggregate_log_lines(read_log_lines(file_path, start, end))
 
-        url_stats[url]["count"] += 1
-        url_stats[url]["time_sum"] += request_time
-        url_stats[url]["time_list"].append(request_time)
 
-        total_count += 1
-        total_time += request_time
+def init_worker(log_file: Optional[str]) -> None:
+    """Setting up logging in a worker process
 
-    # Calculate final metrics
-    result = {}
-    for url, stats in url_stats.items():
-        time_list = stats["time_list"]
-        result[url] = {
-            "count": stats["count"],
-            "count_perc": (
-                round(stats["count"] / total_count * 100, 2) if total_count > 0 else 0
-            ),
-            "time_sum": round(stats["time_sum"], 3),
-            "time_perc": (
-                round(stats["time_sum"] / total_time * 100, 2) if total_time > 0 else 0
-            ),
-            "time_avg": (
-                round(stats["time_sum"] / stats["count"], 3)
-                if stats["count"] > 0
-                else 0
-            ),
-            "time_max": round(max(time_list), 3) if time_list else 0,
-            "time_med": round(statistics.median(time_list), 3) if time_list else 0,
-        }
+    Workers started with spawn or forkserver import this module afresh, so
+    they do not inherit the logging set up by main().
+    """
+    setup_logging(log_file)
 
-    return result
+
+def init_batch_worker(
+    batch_queue: "multiprocessing.Queue[Optional[bytes]]", log_file: Optional[str]
+) -> None:
+    """Setting up a worker process to take gzipped log batches from a queue"""
+    global _batch_queue
+    _batch_queue = batch_queue
+    init_worker(log_file)
+
+
+def aggregate_queued_batches() -> Tuple[UrlAggregates, int, int]:
+    """Parsing and aggregating queued batches of whole log lines until None"""
+    batch_queue = _batch_queue
+    assert batch_queue is not None
+
+    def read_lines() -> Iterator[bytes]:
+        for batch in iter(batch_queue.get, None):
+            lines = batch.split(b"\n")
+            # The batch ends with a newline unless it is the end of the file
+            if not lines[-1]:
+                lines.pop()
+            yield from lines
+
+    return aggregate_log_lines(read_lines())
+
+
+def aggregate_plain_log_parallel(
+    file_path: str, workers: int, log_file: Optional[str] = None
+) -> Iterator[Tuple[UrlAggregates, int, int]]:
+    """Aggregating a plain log file in one byte range per worker"""
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=(log_file,)
+    ) as executor:
+        futures = [
+            executor.submit(aggregate_log_chunk, file_path, start, end)
+            for start, end in find_chunk_offsets(file_path, workers)
+        ]
+        for future in futures:
+            yield future.result()
+
+
+def aggregate_gzip_log_parallel(
+    file_path: str, workers: int, log_file: Optional[str] = None
+) -> Iterator[Tuple[UrlAggregates, int, int]]:
+    """Aggregating a gzipped log file streamed in batches to the workers
+
+    Every worker takes batches from a shared queue until it gets None, so
+    each one returns a single partial result however long the log is.
+    """
+    batch_queue: "multiprocessing.Queue[Optional[bytes]]" = multiprocessing.Queue(
+        maxsize=2 * workers
+    )
+
+    completed = False
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_batch_worker,
+            initargs=(batch_queue, log_file),
+        ) as executor:
+            # All workers are started before the log is opened: rapidgzip
+            # decompresses on threads, and forking a threaded process can
+            # deadlock
+            futures = [
+                executor.submit(aggregate_queued_batches) for _ in range(workers)
+            ]
+
+            def put_batch(batch: Optional[bytes]) -> None:
+                while True:
+                    try:
+                        batch_queue.put(batch, timeout=1)
+                        return
+                    except queue.Full:
+                        # A worker that stopped before its None has failed
+                        for future in futures:
+                            if future.done():
+                                future.result()
+                                raise RuntimeError("Log worker stopped early")
+
+            try:
+                for batch in read_log_batches(file_path, BATCH_SIZE):
+                    put_batch(batch)
+            finally:
+                # Every worker stops at its None, also if reading failed
+                for _ in futures:
+                    put_batch(None)
+
+            for future in futures:
+                yield future.result()
+        completed = True
+    finally:
+        # The pool is shut down, so nothing reads the queue any more. If a
+        # worker died, the feeder thread can stay blocked on a batch in the
+        # pipe, and joining it at interpreter exit would hang forever.
+        if not completed:
+            batch_queue.cancel_join_thread()
+        batch_queue.close()
+        # Every batch was taken, so the feeder thread ends at once; joining
+        # it leaves no thread behind to be forked with the next pool
+        if completed:
+            batch_queue.join_thread()
+
+
+def calculate_statistics_parallel(
+    file_path: str,
+    error_threshold: float,
+    workers: int,
+    limit: Optional[int] = None,
+    log_file: Optional[str] = None,
+) -> Dict[str, Dict]:
+    """Calculating statistics by URL, parsing parts of a log in parallel
+
+    Every worker returns one partial result. Merging the median histograms
+    gives the same time_med as parsing the log sequentially. The workers
+    log to log_file, or to stdout without it, like main() does.
+    """
+    logger.info("parallel_parsing_started", file=file_path, workers=workers)
+
+    aggregates = UrlAggregates({}, array("Q"), array("d"), array("d"), [])
+    counts = LineCounts()
+
+    if file_path.endswith(".gz"):
+        parts = aggregate_gzip_log_parallel(file_path, workers, log_file)
+    else:
+        parts = aggregate_plain_log_parallel(file_path, workers, log_file)
+
+    with log_parse_errors(file_path):
+        for part_aggregates, part_total, part_errors in parts:
+            merge_aggregates(aggregates, part_aggregates)
+            counts.total_lines += part_total
+            counts.error_lines += part_errors
+
+    finish_parse(counts, error_threshold)
+    return summarize_aggregates(aggregates, limit)
 
 
 def generate_report(
     stats: Dict[str, Dict], report_size: int, template_path: str, output_path: str
 ) -> None:
     """Generating HTML report"""
-    logger = structlog.get_logger()
-
-    # Sort by time_sum and size limit
-    sorted_urls = sorted(stats.items(), key=lambda x: x[1]["time_sum"], reverse=True)[
-        :report_size
-    ]
+    # Top URLs by time_sum, without sorting all of them
+    sorted_urls = heapq.nlargest(
+        report_size, stats.items(), key=lambda x: x[1]["time_sum"]
+    )
 
     # Preparing data for the template
     table_data = []
     for url, url_stats in sorted_urls:
         table_data.append({"url": url, **url_stats})
 
-    # Reading template
+    # Reading template, split around the $table_json placeholder
     with open(template_path, "r", encoding="utf-8") as f:
-        template_content = f.read()
+        head, placeholder, tail = f.read().partition("$table_json")
 
-    # Replace $table_json in template
-    template = Template(template_content)
-    report_content = template.safe_substitute(table_json=json.dumps(table_data))
+    if orjson is not None:
+        table_json = orjson.dumps(table_data)
+    else:
+        table_json = json.dumps(table_data).encode()
 
-    # Saving the report
+    # Saving the report piece by piece instead of substituting into a copy
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    with open(output_path, "w", encoding="utf-8") as f:
-        f.write(report_content)
+    with open(output_path, "wb") as f:
+        f.write(head.encode())
+        if placeholder:
+            f.write(table_json)
+            f.write(tail.encode())
 
     logger.info("report_generated", path=output_path)
 
 
 def check_report_exists(report_path: str) -> bool:
     """Checking for report existence"""
-    return os.path.exists(report_path)
+    # lstat only: a report path is never expected to be a symlink to follow
+    return os.path.lexists(report_path)
 
 
 def main() -> int:
@@ -306,7 +841,6 @@ def main() -> int:
 
     # Setup logging
     setup_logging()
-    logger = structlog.get_logger()
 
     try:
         # Config loading
@@ -338,13 +872,21 @@ def main() -> int:
             logger.info("report_already_exists", path=report_path)
             return 0
 
-        # Parsing the log
+        # Parsing the log and calculating statistics in a single pass
         logger.info("parsing_started", file=latest_log.path)
-        log_entries = list(parse_log_file(latest_log.path, config["ERROR_THRESHOLD"]))
-
-        # Calculating statistics
-        logger.info("calculating_statistics", entries_count=len(log_entries))
-        stats = calculate_statistics(log_entries)
+        workers = os.cpu_count() or 1
+        if workers > 1 and os.path.getsize(latest_log.path) >= PARALLEL_MIN_SIZE:
+            stats = calculate_statistics_parallel(
+                latest_log.path,
+                config["ERROR_THRESHOLD"],
+                workers,
+                config["REPORT_SIZE"],
+                config.get("LOG_FILE"),
+            )
+        else:
+            log_entries = parse_log_file(latest_log.path, config["ERROR_THRESHOLD"])
+            stats = calculate_statistics(log_entries, config["REPORT_SIZE"])
+        logger.info("statistics_calculated", urls_count=len(stats))
 
         # Rendering the report
         template_path = os.path.join("templates", "report.html")
@@ -1,47 +1,78 @@
+import gzip
 import json
+import multiprocessing
 import os
-import tempfile
+import random
+import statistics
+import subprocess
+import sys
+import textwrap
+import threading
+from collections import namedtuple
+from contextlib import nullcontext
 from datetime import datetime
 from pathlib import Path
+from typing import Dict
 
+import pytest
+
+from log_analyzer import log_analyzer
 from log_analyzer.log_analyzer import (
+    MEDIAN_EXACT_SAMPLES,
+    MEDIAN_RELATIVE_ACCURACY,
+    MedianHistogram,
     calculate_statistics,
+    calculate_statistics_parallel,
     check_report_exists,
     default_config,
+    find_chunk_offsets,
     find_latest_log,
     load_config,
+    parse_log_file,
     parse_log_line,
+    read_log_batches,
+    read_log_lines,
+)
+
+LOG_LINE = (
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET {url} HTTP/1.1" '
+    '200 927 "-" "Lynx/2.8.8dev.9" "-" "1498697422-2190034393" "dc7161be3" '
+    "{time}\n"
 )
 
 
 class TestConfig:
-    def test_load_config_default(self) -> None:
+    def test_load_config_default(self, tmp_path: Path) -> None:
         """Test loading config with default values"""
-        with tempfile.NamedTemporaryFile(mode="w", suffix=".json", delete=False) as f:
-            json.dump({}, f)
-            config_path = f.name
-
-        try:
-            config = load_config(config_path, default_config)
-            assert config["REPORT_SIZE"] == default_config["REPORT_SIZE"]
-            assert config["ERROR_THRESHOLD"] == default_config["ERROR_THRESHOLD"]
-        finally:
-            os.unlink(config_path)
-
-    def test_load_config_override(self) -> None:
+        config_path = tmp_path / "config.json"
+        config_path.write_text("{}")
+
+        config = load_config(str(config_path), default_config)
+        assert config["REPORT_SIZE"] == default_config["REPORT_SIZE"]
+        assert config["ERROR_THRESHOLD"] == default_config["ERROR_THRESHOLD"]
+
+    def test_load_config_override(self, tmp_path: Path) -> None:
         """Default Values Overwriting Test"""
-        with tempfile.NamedTemporaryFile(mode="w", suffix=".json", delete=False) as f:
-            json.dump({"REPORT_SIZE": 500}, f)
-            config_path = f.name
-
-        try:
-            config = load_config(config_path, default_config)
-            assert config["REPORT_SIZE"] == 500
-            assert (
-                config["ERROR_THRESHOLD"] == default_config["ERROR_THRESHOLD"]
-            )  # defualt value
-        finally:
-            os.unlink(config_path)
+        config_path = tmp_path / "config.json"
+        config_path.write_text(json.dumps({"REPORT_SIZE": 500}))
+
+        config = load_config(str(config_path), default_config)
+        assert config["REPORT_SIZE"] == 500
+        assert (
+            config["ERROR_THRESHOLD"] == default_config["ERROR_THRESHOLD"]
+        )  # defualt value
+
+    def test_load_config_reload_on_change(self, tmp_path: Path) -> None:
+        """Changed config file re-reading test"""
+        config_path = tmp_path / "config.json"
+        config_path.write_text(json.dumps({"REPORT_SIZE": 500}))
+        assert load_config(str(config_path), default_config)["REPORT_SIZE"] == 500
+
+        config_path.write_text(json.dumps({"REPORT_SIZE": 700}))
+        mtime = config_path.stat().st_mtime_ns + 1_000_000_000
+        os.utime(config_path, ns=(mtime, mtime))
+
+        assert load_config(str(config_path), default_config)["REPORT_SIZE"] == 700
 
     def test_load_config_not_found(self) -> None:
         """Missing config test"""
@@ -55,53 +86,118 @@ class TestLogParsing:
     def test_parse_valid_line(self) -> None:
         """Correct string parsing test"""
         line = (
-            "1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "
-            '"GET /api/v2/banner/25019354 HTTP/1.1" 200 927 '
-            '"-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" '
-            '"-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.390'
+            b"1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "
+            b'"GET /api/v2/banner/25019354 HTTP/1.1" 200 927 '
+            b'"-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" '
+            b'"-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n'
         )
 
         result = parse_log_line(line)
-        assert result is not None
-        assert result["url"] == "/api/v2/banner/25019354"
-        assert result["request_time"] == 0.390
+        assert result == ("/api/v2/banner/25019354", 0.390)
+
+    def test_parse_line_trailing_whitespace(self) -> None:
+        """Unstripped line endings and trailing fields parsing test"""
+        line = (
+            b"1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "
+            b'"GET /api/v2/banner/25019354 HTTP/1.1" 200 927 '
+            b'"-" "Lynx/2.8.8dev.9" "-" "1498697422-2190034393" "dc7161be3" 0.390'
+        )
+
+        for ending in (b"", b"\n", b"\r\n", b"  \n", b" 0.200\n"):
+            result = parse_log_line(line + ending)
+            assert result == ("/api/v2/banner/25019354", 0.390)
+
+    def test_parse_line_url_pool(self) -> None:
+        """Repeated URLs share one str through a url_pool"""
+        line = LOG_LINE.format(url="/api/v2/banner/1", time="0.390").encode()
+
+        url_pool: Dict[bytes, str] = {}
+        first = parse_log_line(line, url_pool)
+        second = parse_log_line(line, url_pool)
+        assert first is not None and second is not None
+        assert first[0] is second[0]
+        assert url_pool == {b"/api/v2/banner/1": "/api/v2/banner/1"}
+
+        assert parse_log_line(line) == ("/api/v2/banner/1", 0.390)
+
+    def test_parse_line_invalid_request_time(self) -> None:
+        """Non-decimal request_time parsing test"""
+        for request_time in ("nan", "inf", "-1.0", "-", "1e3", "1_0.5", "5"):
+            line = LOG_LINE.format(url="/api/v2/banner/1", time=request_time)
+            assert parse_log_line(line.encode()) is None
+
+        assert parse_log_line(b'garbage "x" 0.5\n') is None
 
     def test_parse_invalid_line(self) -> None:
         """Invalid string parsing test"""
-        line = "invalid log line"
+        line = b"invalid log line\n"
         result = parse_log_line(line)
         assert result is None
 
 
+class TestLogReading:
+    def test_read_log_lines(self, tmp_path: Path) -> None:
+        """Plain and gzipped logs reading test"""
+        content = b"first line\nsecond line\nlast line without newline"
+        plain_path = tmp_path / "nginx-access-ui.log-20170630"
+        plain_path.write_bytes(content)
+        gz_path = tmp_path / "nginx-access-ui.log-20170701.gz"
+        with gzip.open(gz_path, "wb") as f:
+            f.write(content)
+        empty_path = tmp_path / "nginx-access-ui.log-20170702"
+        empty_path.touch()
+
+        expected = content.splitlines(keepends=True)
+        assert list(read_log_lines(str(plain_path))) == expected
+        assert list(read_log_lines(str(gz_path))) == expected
+        assert list(read_log_lines(str(empty_path))) == []
+
+
+FakeEntry = namedtuple("FakeEntry", ["name", "path"])
+
+LOG_NAMES = (
+    "nginx-access-ui.log-20170630",
+    "nginx-access-ui.log-20170629.gz",
+    "nginx-access-ui.log-20170701.gz",
+    "some-other.log",
+)
+
+
 class TestLogFinder:
-    def test_find_latest_log(self) -> None:
+    def test_find_latest_log(self, tmp_path: Path, monkeypatch) -> None:
         """Last Log Search Test"""
-        with tempfile.TemporaryDirectory() as tmpdir:
-            # Create log files
-            Path(tmpdir, "nginx-access-ui.log-20170630").touch()
-            Path(tmpdir, "nginx-access-ui.log-20170629.gz").touch()
-            Path(tmpdir, "nginx-access-ui.log-20170701.gz").touch()
-            Path(tmpdir, "some-other.log").touch()
-
-            result = find_latest_log(tmpdir)
-            assert result is not None
-            assert result.date == datetime(2017, 7, 1)
-            assert result.path.endswith("nginx-access-ui.log-20170701.gz")
-
-    def test_find_latest_log_empty_dir(self) -> None:
+        entries = [FakeEntry(name, str(tmp_path / name)) for name in LOG_NAMES]
+        entries.append(FakeEntry("nginx-access-ui.log-20171301.gz", "invalid"))
+        monkeypatch.setattr(os, "scandir", lambda path: nullcontext(entries))
+
+        result = find_latest_log(str(tmp_path))
+        assert result is not None
+        assert result.date == datetime(2017, 7, 1)
+        assert result.path.endswith("nginx-access-ui.log-20170701.gz")
+        assert result.extension == ".gz"
+
+    def test_find_latest_log_fs(self, tmp_path: Path) -> None:
+        """Last Log Search Test on a real directory"""
+        for name in LOG_NAMES:
+            (tmp_path / name).touch()
+
+        result = find_latest_log(str(tmp_path))
+        assert result is not None
+        assert result.date == datetime(2017, 7, 1)
+        assert result.path.endswith("nginx-access-ui.log-20170701.gz")
+
+    def test_find_latest_log_empty_dir(self, tmp_path: Path) -> None:
         """Search test in empty directory"""
-        with tempfile.TemporaryDirectory() as tmpdir:
-            result = find_latest_log(tmpdir)
-            assert result is None
+        assert find_latest_log(str(tmp_path)) is None
 
 
 class TestStatistics:
     def test_calculate_statistics(self) -> None:
         """Statistics calculation test"""
         log_entries = [
-            {"url": "/api/v2/banner/1", "request_time": 0.1},
-            {"url": "/api/v2/banner/1", "request_time": 0.2},
-            {"url": "/api/v2/banner/2", "request_time": 0.3},
+            ("/api/v2/banner/1", 0.1),
+            ("/api/v2/banner/1", 0.2),
+            ("/api/v2/banner/2", 0.3),
         ]
 
         stats = calculate_statistics(log_entries)
@@ -113,11 +209,292 @@ class TestStatistics:
         assert stats["/api/v2/banner/1"]["time_max"] == 0.2
         assert stats["/api/v2/banner/1"]["time_med"] == 0.15
 
+    def test_calculate_statistics_parallel(self, tmp_path: Path, monkeypatch) -> None:
+        """Chunked parallel statistics calculation test"""
+        # Enough requests per URL and chunk for the medians to be estimated
+        rng = random.Random(42)
+        lines = [
+            LOG_LINE.format(
+                url=f"/api/v2/banner/{i % 3}",
+                time="0.000" if i % 3 == 2 else f"{rng.lognormvariate(-2, 1):.3f}",
+            )
+            for i in range(3000)
+        ]
+        log_path = tmp_path / "nginx-access-ui.log-20170630"
+        log_path.write_text("".join(lines) + "invalid log line\n")
+
+        offsets = find_chunk_offsets(str(log_path), 3)
+        assert offsets[0][0] == 0
+        assert offsets[-1][1] == log_path.stat().st_size
+
+        expected = calculate_statistics(parse_log_file(str(log_path), 0.1))
+
+        def assert_close(stats: Dict[str, Dict]) -> None:
+            assert stats.keys() == expected.keys()
+            for url, url_stats in stats.items():
+                assert url_stats["count"] == expected[url]["count"]
+                assert url_stats["time_max"] == expected[url]["time_max"]
+                assert abs(url_stats["time_sum"] - expected[url]["time_sum"]) < 0.01
+                # Merged medians match the sequential ones
+                assert url_stats["time_med"] == expected[url]["time_med"]
+
+        assert_close(calculate_statistics_parallel(str(log_path), 0.1, 3))
+        # Few requests per URL and worker, kept exactly before the merge
+        assert_close(calculate_statistics_parallel(str(log_path), 0.1, 20))
+
+        gz_path = tmp_path / "nginx-access-ui.log-20170701.gz"
+        with gzip.open(gz_path, "wb") as f:
+            f.write(log_path.read_bytes())
+
+        batches = list(read_log_batches(str(gz_path), 100))
+        assert len(batches) > 1
+        assert all(batch.endswith(b"\n") for batch in batches)
+        assert b"".join(batches) == log_path.read_bytes()
+
+        # Many small batches are still merged once per worker
+        monkeypatch.setattr(log_analyzer, "BATCH_SIZE", 4096)
+        assert_close(calculate_statistics_parallel(str(gz_path), 0.1, 3))
+
+    def test_calculate_statistics_parallel_logging(
+        self, tmp_path: Path, monkeypatch
+    ) -> None:
+        """Parallel parsing logs progress from the workers and errors"""
+        # Enough lines for every worker to report progress once; nothing is
+        # patched, as workers started with spawn or forkserver would not see it
+        workers = 2
+        line_count = workers * log_analyzer.PROGRESS_INTERVAL + 1000
+        log_path = tmp_path / "nginx-access-ui.log-20170630"
+        line = LOG_LINE.format(url="/api/v2/banner/1", time="0.100")
+        log_path.write_text(line * line_count)
+        log_file = tmp_path / "analyzer.log"
+
+        stats = calculate_statistics_parallel(
+            str(log_path), 0.1, workers, log_file=str(log_file)
+        )
+        assert stats["/api/v2/banner/1"]["count"] == line_count
+
+        # The workers set up logging themselves and write JSON to log_file
+        events = [json.loads(line) for line in log_file.read_text().splitlines()]
+        progress = [e for e in events if e["event"] == "parse_progress"]
+        assert len({e["pid"] for e in progress}) == workers
+
+        # Errors are logged by the parent process
+        logged = []
+        monkeypatch.setattr(
+            log_analyzer.logger, "error", lambda event, **kw: logged.append(event)
+        )
+        with pytest.raises(FileNotFoundError):
+            calculate_statistics_parallel(str(tmp_path / "missing"), 0.1, workers)
+        assert logged == ["parse_error"]
+
+    def test_calculate_statistics_parallel_rapidgzip(
+        self, tmp_path: Path, monkeypatch
+    ) -> None:
+        """Workers are not forked from the threaded rapidgzip reader"""
+        if log_analyzer.rapidgzip is None:
+            pytest.skip("rapidgzip is not installed")
+
+        gz_path = tmp_path / "nginx-access-ui.log-20170701.gz"
+        with gzip.open(gz_path, "wt") as f:
+            for i in range(1000):
+                f.write(LOG_LINE.format(url=f"/api/v2/banner/{i % 3}", time="0.100"))
+
+        # Thread count and whether the log is open, as each worker is forked
+        forks = []
+        opened = []
+        fork = os.fork
+        rapidgzip_open = log_analyzer.rapidgzip.open
+
+        def fork_spy() -> int:
+            forks.append((threading.active_count(), bool(opened)))
+            return fork()
+
+        def rapidgzip_open_spy(*args, **kwargs):
+            opened.append(True)
+            return rapidgzip_open(*args, **kwargs)
+
+        monkeypatch.setattr(os, "fork", fork_spy)
+        monkeypatch.setattr(log_analyzer.rapidgzip, "open", rapidgzip_open_spy)
+        # rapidgzip is only used with more than one CPU
+        monkeypatch.setattr(os, "cpu_count", lambda: 4)
+        monkeypatch.setattr(log_analyzer, "BATCH_SIZE", 4096)
+        stats = calculate_statistics_parallel(str(gz_path), 0.1, 3)
+
+        assert stats["/api/v2/banner/0"]["count"] == 334
+        assert opened
+        # Forked workers come from a single-threaded parent, before the log
+        # is opened; with spawn or forkserver the parent does not fork
+        if multiprocessing.get_start_method() == "fork":
+            assert forks == [(1, False)] * 3
+        else:
+            assert not forks
+
+    def test_calculate_statistics_parallel_worker_crash(self, tmp_path: Path) -> None:
+        """A crashed gz worker fails the call without hanging the process"""
+        gz_path = tmp_path / "nginx-access-ui.log-20170701.gz"
+        with gzip.open(gz_path, "wt") as f:
+            for i in range(20000):
+                f.write(LOG_LINE.format(url=f"/api/v2/banner/{i % 3}", time="0.100"))
+
+        # Workers die at once, leaving batches bigger than a pipe unread
+        script = tmp_path / "crash.py"
+        script.write_text(textwrap.dedent("""
+                import os
+                import sys
+
+                from log_analyzer import log_analyzer
+
+                def crash():
+                    os._exit(1)
+
+                if __name__ == "__main__":
+                    log_analyzer.aggregate_queued_batches = crash
+                    log_analyzer.BATCH_SIZE = 256 * 1024
+                    try:
+                        log_analyzer.calculate_statistics_parallel(sys.argv[1], 0.1, 2)
+                    except Exception as e:
+                        print(type(e).__name__)
+                """))
+        src_dir = os.path.dirname(os.path.dirname(log_analyzer.__file__))
+        env = {**os.environ, "PYTHONPATH": src_dir}
+
+        result = subprocess.run(
+            [sys.executable, str(script), str(gz_path)],
+            capture_output=True,
+            env=env,
+            text=True,
+            timeout=60,
+        )
+        assert result.returncode == 0, result.stderr
+        assert result.stdout.splitlines()[-1] in ("BrokenProcessPool", "RuntimeError")
+
+    def test_median_histogram(self) -> None:
+        """Streaming median estimate test"""
+        rng = random.Random(42)
+        # Latencies drifting upwards over the log, as under a growing load
+        values = [rng.lognormvariate(-2, 1) * (1 + 3 * i / 10000) for i in range(10000)]
+
+        medians = []
+        for ordered in (values, sorted(values), sorted(values, reverse=True)):
+            median = MedianHistogram()
+            for value in ordered:
+                median.add(value)
+            medians.append(median.median())
+
+        # The estimate does not depend on the order of the timings
+        assert medians[0] == medians[1] == medians[2]
+        assert medians[0] == pytest.approx(
+            statistics.median(values), rel=MEDIAN_RELATIVE_ACCURACY
+        )
+
+    def test_median_histogram_merge(self) -> None:
+        """Merging streaming median estimates test"""
+        rng = random.Random(42)
+        values = [rng.expovariate(5) for _ in range(10000)]
+
+        sequential = MedianHistogram()
+        for value in values:
+            sequential.add(value)
+
+        # Parts both below and above the sample limit
+        merged = MedianHistogram()
+        for start, end in ((0, 30), (30, 2500), (2500, 2540), (2540, 10000)):
+            part = MedianHistogram()
+            for value in values[start:end]:
+                part.add(value)
+            merged.merge(part)
+
+        assert merged.count == len(values)
+        assert merged.median() == sequential.median()
+
+        # Below the sample limit on both sides the merge is exact
+        small = MedianHistogram()
+        for value in values[:30]:
+            small.add(value)
+        other = MedianHistogram()
+        for value in values[30:60]:
+            other.add(value)
+        small.merge(other)
+        assert small.median() == statistics.median(values[:60])
+
+    def test_median_histogram_merge_ties(self) -> None:
+        """Merging estimates of constant and tie-heavy timings test"""
+        constant = MedianHistogram()
+        other = MedianHistogram()
+        for _ in range(100):
+            constant.add(0.0)
+            other.add(0.0)
+        constant.merge(other)
+        assert constant.median() == 0.0
+
+        rng = random.Random(1)
+        for _ in range(200):
+            choices = rng.sample([0.0, 0.001, 0.002, 0.5], rng.randint(1, 3))
+            merged = MedianHistogram()
+            for _ in range(3):
+                part = MedianHistogram()
+                for _ in range(rng.randint(1, 300)):
+                    part.add(rng.choice(choices))
+                merged.merge(part)
+            low = min(choices) * (1 - MEDIAN_RELATIVE_ACCURACY)
+            high = max(choices) * (1 + MEDIAN_RELATIVE_ACCURACY)
+            assert low <= merged.median() <= high
+
+    def test_median_histogram_exact_samples(self) -> None:
+        """Median of a low-traffic URL is exact"""
+        rng = random.Random(7)
+        for size in (1, 2, 7, 20, MEDIAN_EXACT_SAMPLES):
+            values = [rng.lognormvariate(-2, 1) for _ in range(size)]
+            median = MedianHistogram()
+            for value in values:
+                median.add(value)
+            assert median.median() == statistics.median(values)
+
 
 class TestReportCheck:
-    def test_check_report_exists(self) -> None:
+    def test_check_report_exists(self, tmp_path: Path) -> None:
         """Report Existence Check Test"""
-        with tempfile.NamedTemporaryFile() as f:
-            assert check_report_exists(f.name) is True
+        report_path = tmp_path / "report-2017.06.30.html"
+        report_path.touch()
+        assert check_report_exists(str(report_path)) is True
 
         assert check_report_exists("/non/existent/file.html") is False
+
+
+class TestMain:
+    def test_main_parallel(self, tmp_path: Path, monkeypatch) -> None:
+        """Large logs are parsed in parallel by main()"""
+        log_dir = tmp_path / "log"
+        log_dir.mkdir()
+        (log_dir / "nginx-access-ui.log-20170630").write_text(
+            "".join(
+                LOG_LINE.format(url=f"/api/v2/banner/{i % 2}", time=f"{i / 100:.3f}")
+                for i in range(200)
+            )
+        )
+        config_path = tmp_path / "config.json"
+        config_path.write_text(
+            json.dumps({"LOG_DIR": str(log_dir), "REPORT_DIR": str(tmp_path)})
+        )
+
+        calls = []
+
+        def calculate_statistics_parallel_spy(*args, **kwargs):
+            calls.append(args)
+            return calculate_statistics_parallel(*args, **kwargs)
+
+        monkeypatch.setattr(
+            log_analyzer,
+            "calculate_statistics_parallel",
+            calculate_statistics_parallel_spy,
+        )
+        monkeypatch.setattr(log_analyzer, "PARALLEL_MIN_SIZE", 0)
+        monkeypatch.setattr(os, "cpu_count", lambda: 2)
+        monkeypatch.setattr("sys.argv", ["log_analyzer", "--config", str(config_path)])
+        # The report template is looked up relative to the project root
+        monkeypatch.chdir(Path(__file__).resolve().parent.parent)
+
+        assert log_analyzer.main() == 0
+        assert len(calls) == 1
+        report = (tmp_path / "report-2017.06.30.html").read_text()
+        assert "/api/v2/banner/1" in report